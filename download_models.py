@@ -1,24 +1,65 @@
 #!/usr/bin/env python3
 """
 Pre-warms all PaddleOCR / PaddlePaddle models at Docker BUILD time.
-Run via: python3 /app/download_models.py
+Run via: python3 /app/download_models.py [--det DIR] [--rec DIR] [--cls DIR]
+                                         [--lang LANG] [--lock FILE] [--sanity-check]
+
+Defaults come from models.lock (OCR_LANG, PADDLEOCR_VERSION), then from the
+environment (PPOCR_*_DIR, OCR_LANG). The installed paddleocr must match the
+PADDLEOCR_VERSION pinned in the lock file. --sanity-check runs one inference
+on a page of dark bars once the pipeline is built and requires recognized text,
+so a broken model fails the build.
 
 This ensures that ALL models — including the extra PaddleX models that
 paddleocr==3.4.0 downloads on first use (PP-LCNet_x1_0_doc_ori, UVDoc, etc.)
 — are baked into the image and not fetched at container startup.
+
+With OCR_BACKEND=hpi, PaddleOCR is initialized with high-performance inference
+enabled, so the backend (OpenVINO / ONNX Runtime on CPU) is set up — and any
+artifacts it writes are baked — at build time rather than on first start.
 """
+import argparse
 import os
 import sys
+from importlib.metadata import PackageNotFoundError, version
 from pathlib import Path
 
 # Désactive OneDNN : PP-OCRv5 server crash à l'inférence sinon
 os.environ.setdefault("FLAGS_use_mkldnn", "0")
 os.environ["PADDLE_PDX_DISABLE_MODEL_SOURCE_CHECK"] = "True"
 
-# ─── Model dirs ───────────────────────────────────────────────────────────────
-DET_DIR = os.environ.get("PPOCR_DET_DIR", "/models/ppocrv5/det")
-REC_DIR = os.environ.get("PPOCR_REC_DIR", "/models/ppocrv5/rec")
-CLS_DIR = os.environ.get("PPOCR_CLS_DIR", "/models/ppocrv5/cls")
+LOCK_FILE = os.environ.get("OCR_MODELS_LOCK", "/app/models.lock")
+
+HPI = os.environ.get("OCR_BACKEND", "paddle") == "hpi"
+
+# ─── models.lock ──────────────────────────────────────────────────────────────
+def read_lock(path: str) -> dict:
+    """models.lock (KEY=VALUE, commentaires #) → dict. Fichier absent → {}."""
+    lock = {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#") or "=" not in line:
+                    continue
+                key, value = line.split("=", 1)
+                lock[key.strip()] = value.strip().strip('"')
+    except FileNotFoundError:
+        print(f"[WARN] No lock file at {path}", flush=True)
+    return lock
+
+
+def check_paddleocr_version(expected: str) -> None:
+    try:
+        installed = version("paddleocr")
+    except PackageNotFoundError:
+        raise SystemExit("[ERROR] paddleocr is not installed")
+    if expected and installed != expected:
+        raise SystemExit(
+            f"[ERROR] paddleocr {installed} installed, models.lock pins {expected}"
+        )
+    print(f"[OK] paddleocr {installed}", flush=True)
+
 
 # ─── Sanity-check baked model dirs ────────────────────────────────────────────
 def check_dir(p: str) -> None:
@@ -29,44 +70,100 @@ def check_dir(p: str) -> None:
         raise SystemExit(f"[ERROR] Empty directory: {p}")
     print(f"[OK] {p}", flush=True)
 
-print("=== Checking baked PP-OCRv5 model dirs ===", flush=True)
-check_dir(DET_DIR)
-check_dir(REC_DIR)
-check_dir(CLS_DIR)
 
 # ─── Init PaddleOCR with the NEW 3.4.0 API ────────────────────────────────────
 # This triggers ALL lazy model downloads (UVDoc, PP-LCNet_x1_0_doc_ori, etc.)
 # so they end up in $PADDLEX_HOME and are copied into the runtime image.
-print("=== Initializing PaddleOCR (will download auxiliary models) ===", flush=True)
-try:
-    from paddleocr import PaddleOCR
-
-    ocr = PaddleOCR(
-        lang="fr",
-        device="cpu",
-        use_textline_orientation=True,
-        text_detection_model_dir=DET_DIR,
-        text_recognition_model_dir=REC_DIR,
-        textline_orientation_model_dir=CLS_DIR,
-    )
-    print("[OK] PaddleOCR initialized with new API.", flush=True)
-
-except TypeError as e:
-    # Fallback: old API (should not happen with paddleocr==3.4.0)
-    print(f"[WARN] New API failed ({e}), falling back to legacy API.", flush=True)
-    from paddleocr import PaddleOCR
-    ocr = PaddleOCR(
-        lang="fr",
-        use_angle_cls=True,
-        use_gpu=False,
-        det_model_dir=DET_DIR,
-        rec_model_dir=REC_DIR,
-        cls_model_dir=CLS_DIR,
-    )
-    print("[OK] PaddleOCR initialized with legacy API.", flush=True)
-
-except Exception as e:
-    print(f"[ERROR] PaddleOCR init failed: {e}", flush=True)
-    sys.exit(1)
-
-print("=== All models ready. Build cache is warm. ===", flush=True)
\ No newline at end of file
+def init_paddleocr(det_dir: str, rec_dir: str, cls_dir: str, lang: str):
+    print("=== Initializing PaddleOCR (will download auxiliary models) ===", flush=True)
+    try:
+        from paddleocr import PaddleOCR
+
+        ocr = PaddleOCR(
+            lang=lang,
+            device="cpu",
+            use_textline_orientation=True,
+            text_detection_model_dir=det_dir,
+            text_recognition_model_dir=rec_dir,
+            textline_orientation_model_dir=cls_dir,
+            **({"enable_hpi": True} if HPI else {}),
+        )
+        print("[OK] PaddleOCR initialized with new API.", flush=True)
+
+    except TypeError as e:
+        # Fallback: old API (should not happen with paddleocr==3.4.0)
+        print(f"[WARN] New API failed ({e}), falling back to legacy API.", flush=True)
+        from paddleocr import PaddleOCR
+        ocr = PaddleOCR(
+            lang=lang,
+            use_angle_cls=True,
+            use_gpu=False,
+            det_model_dir=det_dir,
+            rec_model_dir=rec_dir,
+            cls_model_dir=cls_dir,
+        )
+        print("[OK] PaddleOCR initialized with legacy API.", flush=True)
+
+    except Exception as e:
+        print(f"[ERROR] PaddleOCR init failed: {e}", flush=True)
+        sys.exit(1)
+
+    return ocr
+
+
+def sanity_check(ocr) -> None:
+    """
+    Une inférence sur une page barrée de traits noirs (comme warmup_model côté
+    worker) : une page blanche ne produit aucune boîte, donc ne prouve rien de la
+    reconnaissance. Échoue si aucun texte n'est reconnu.
+    """
+    import numpy as np
+
+    page = np.full((640, 640, 3), 255, dtype=np.uint8)
+    for y in range(80, 600, 160):
+        page[y:y + 24, 64:576] = 0
+    try:
+        if hasattr(ocr, "predict"):
+            results = list(ocr.predict(page))
+            texts = [t for res in results for t in (res.get("rec_texts") or [])]
+        else:
+            results = ocr.ocr(page)
+            texts = [line[1][0] for page_res in (results or []) for line in (page_res or [])]
+    except Exception as e:
+        print(f"[ERROR] Sanity-check inference failed: {e}", flush=True)
+        sys.exit(1)
+    if not texts:
+        print("[ERROR] Sanity-check produced no rec_texts: det/rec pipeline is broken.", flush=True)
+        sys.exit(1)
+    print(f"[OK] Sanity-check inference ({len(texts)} text lines).", flush=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Bake PaddleOCR models at build time.")
+    parser.add_argument("--lock", default=LOCK_FILE, help="models.lock (KEY=VALUE)")
+    parser.add_argument("--det", default=os.environ.get("PPOCR_DET_DIR", "/models/ppocrv5/det"))
+    parser.add_argument("--rec", default=os.environ.get("PPOCR_REC_DIR", "/models/ppocrv5/rec"))
+    parser.add_argument("--cls", default=os.environ.get("PPOCR_CLS_DIR", "/models/ppocrv5/cls"))
+    parser.add_argument("--lang", default=None, help="défaut : OCR_LANG du lock, puis env, puis fr")
+    parser.add_argument("--sanity-check", action="store_true", help="inférence de test après init")
+    args = parser.parse_args()
+
+    lock = read_lock(args.lock)
+    lang = args.lang or lock.get("OCR_LANG") or os.environ.get("OCR_LANG", "fr")
+
+    check_paddleocr_version(lock.get("PADDLEOCR_VERSION", ""))
+
+    print("=== Checking baked PP-OCRv5 model dirs ===", flush=True)
+    check_dir(args.det)
+    check_dir(args.rec)
+    check_dir(args.cls)
+
+    ocr = init_paddleocr(args.det, args.rec, args.cls, lang)
+    if args.sanity_check:
+        sanity_check(ocr)
+
+    print("=== All models ready. Build cache is warm. ===", flush=True)
+
+
+if __name__ == "__main__":
+    main()
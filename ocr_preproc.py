@@ -0,0 +1,61 @@
+"""
+Prétraitements optionnels avant OCR (requête `"preproc": "binarize"`).
+
+Noyaux Numba (@njit parallel) : lignes réparties sur les cœurs, boucle interne
+vectorisée par LLVM. Compilés au build Docker (warmup() + NUMBA_CACHE_DIR) pour
+éviter la latence de JIT à la première requête.
+"""
+
+import threading
+
+import numpy as np
+from numba import njit, prange
+
+# Seuil de binarisation par défaut (niveau de gris 0-255)
+DEFAULT_THRESHOLD = 128
+
+# Le pool de threads Numba (workqueue) ne supporte pas deux noyaux parallèles
+# lancés en même temps depuis des threads Python différents.
+_KERNEL_LOCK = threading.Lock()
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def rgb2gray_thresh(img, out, thr):
+    """RGB (H, W, >=3) uint8 → noir/blanc (H, W) : luminance entière BT.601."""
+    h, w = out.shape
+    for i in prange(h):
+        for j in range(w):
+            g = (77 * np.int32(img[i, j, 0]) + 150 * np.int32(img[i, j, 1]) + 29 * np.int32(img[i, j, 2])) >> 8
+            out[i, j] = 0 if g < thr else 255
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def gray_thresh(img, out, thr):
+    """Niveaux de gris (H, W) uint8 → noir/blanc (H, W)."""
+    h, w = out.shape
+    for i in prange(h):
+        for j in range(w):
+            out[i, j] = 0 if img[i, j] < thr else 255
+
+
+def binarize(img, thr: int = DEFAULT_THRESHOLD):
+    """Page rendue (H, W) ou (H, W, 3) → nouvelle image (H, W) uint8 en 0/255."""
+    out = np.empty(img.shape[:2], dtype=np.uint8)
+    with _KERNEL_LOCK:
+        if img.ndim == 2:
+            gray_thresh(img, out, thr)
+        else:
+            rgb2gray_thresh(img, out, thr)
+    return out
+
+
+def warmup() -> None:
+    """
+    Compile (et met en cache disque) les noyaux pour les types vus à l'exécution :
+    Numba spécialise aussi sur le caractère lecture seule des pages rendues
+    (vues np.frombuffer sur le buffer du rasteriseur).
+    """
+    for shape in ((8, 8), (8, 8, 3)):
+        img = np.zeros(shape, dtype=np.uint8)
+        binarize(img)
+        binarize(np.frombuffer(img.tobytes(), dtype=np.uint8).reshape(shape))
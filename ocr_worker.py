@@ -4,33 +4,54 @@ OCR worker persistant — lit des requêtes JSON sur stdin, écrit des réponses
 Modèle PaddleOCR chargé UNE SEULE FOIS au démarrage du process.
 
 Protocole :
-  stdin  → {"id": "abc", "pdf_path": "/tmp/input.pdf"}
+  stdin  → {"id": "abc", "pdf_path": "/tmp/input.pdf", "dpi": 200, "dpi_policy": "fixed",
+            "use_cache": true, "stream": false, "preproc": "binarize"}
   stdout → {"id": "abc", "text": "...", "page_count": N}
          | {"id": "abc", "error": "message"}
+  stream → {"id": "abc", "page": i, "partial_text": "..."}  (une ligne par page, i depuis 0)
+           {"id": "abc", "done": true, "page_count": N}
   stdout → {"ready": true}  (au démarrage, une seule fois)
 
 Options (env) :
   OCR_LANG        : "fr" (défaut) / "en" / ...
-  OCR_DPI         : 300 (défaut)
+  OCR_DPI         : 200 (défaut)
+  OCR_DPI_POLICY  : "fixed" (défaut) / "adaptive" — DPI déduit de la taille du texte
+                    (adaptive : détecteur de sonde chargé au démarrage, +1 copie du détecteur)
+  OCR_BATCH       : 4 (défaut) — pages envoyées ensemble au prédicteur
+  OCR_CONCURRENCY : 1 (défaut) — requêtes traitées en parallèle (threads, inférence sérialisée)
+  OCR_SKIP_NATIVE_TEXT : 1 (défaut) — pages avec couche texte PDF : pas d'OCR
+  OCR_GRAYSCALE   : 1 (défaut) — rendu des pages en niveaux de gris (1 canal)
+  OCR_DOC_PREPROCESS : 1 (défaut) — orientation + redressement UVDoc des pages (paddleocr 3.x) ;
+                    0 : désactivés, les très grandes pages sont alors découpées en bandes
+  OCR_RASTERIZER  : "mupdf" (défaut, PyMuPDF) / "pdfium" (pypdfium2, opt-in) — rendu
+                    des pages ; PyMuPDF reste utilisé pour la couche texte native
+  OCR_WARMUP      : 1 (défaut) — inférences factices au chargement, avant "ready"
   PPOCR_DET_DIR   : /models/ppocrv5/det (défaut)
   PPOCR_REC_DIR   : /models/ppocrv5/rec (défaut)
   PPOCR_CLS_DIR   : /models/ppocrv5/cls (défaut)
+  OCR_MKLDNN      : "auto" (défaut) / 1 / 0 — oneDNN, coupé en auto pour le détecteur server
+  OCR_BACKEND     : "paddle" (défaut) / "hpi" — inférence haute performance PaddleX
+                    (OpenVINO / ONNX Runtime sur CPU, paddleocr >= 3.x + deps hpi)
+  OCR_CACHE_DIR   : /var/cache/ocr (défaut) — cache des résultats par hash BLAKE3 du PDF ("" = off)
+  OCR_CACHE_MAX_MB : 1024 (défaut) — taille max du cache (éviction LRU par mtime)
   PADDLEX_HOME    : /root/.paddlex (défaut PaddleX — override si non-root)
 """
 
 import sys
-import json
 import os
 import logging
+import queue
+import statistics
+import threading
 import traceback
 import builtins
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
 
 # ── Tout vers stderr avant imports ────────────────────────────────────────────
 os.environ["FLAGS_call_stack_level"] = "2"
 os.environ["PADDLE_PDX_DISABLE_MODEL_SOURCE_CHECK"] = "True"
-# Désactive OneDNN/MKL-DNN : PP-OCRv5 server crash avec
-# "ConvertPirAttribute2RuntimeAttribute not support [pir::ArrayAttribute<pir::DoubleAttribute>]"
-os.environ.setdefault("FLAGS_use_mkldnn", "0")
 logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
 
 _orig_print = builtins.print
@@ -44,12 +65,73 @@ def _stderr_print(*args, **kwargs):
 builtins.print = _stderr_print
 
 
+# Requêtes traitées en parallèle (OCR_CONCURRENCY) :
+# - une ligne stdout = un message complet → écriture sous verrou
+# - le prédicteur PaddleOCR n'est pas garanti thread-safe → inférence sérialisée
+# - PyMuPDF / PDFium ne supportent pas les accès concurrents → appels sérialisés
+#   (un verrou par bibliothèque : un rendu PDFium n'attend pas un get_text fitz)
+_EMIT_LOCK = threading.Lock()
+_MODEL_LOCK = threading.Lock()
+_FITZ_LOCK = threading.RLock()
+_PDFIUM_LOCK = threading.Lock()
+
+
 def emit(obj):
-    _orig_print(json.dumps(obj, ensure_ascii=False), file=sys.stdout, flush=True)
+    # orjson sérialise directement en UTF-8 (bytes) → écriture brute sur stdout
+    data = orjson.dumps(obj) + b"\n"
+    with _EMIT_LOCK:
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
 
 
 # ── Chargement modèle ─────────────────────────────────────────────────────────
 
+def _model_name(model_dir: str):
+    """model_name lu dans <model_dir>/inference.yml, ou None."""
+    try:
+        with open(os.path.join(model_dir, "inference.yml"), encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith("model_name:"):
+                    return line.split(":", 1)[1].strip().strip("'\"")
+    except OSError:
+        pass
+    return None
+
+
+def _is_server_model(model_dir: str) -> bool:
+    """Vrai si model_dir contient un modèle PP-OCR « server » (ou inconnu)."""
+    name = _model_name(model_dir)
+    # Modèle non identifiable (ex. défauts PaddleOCR = server) → prudence
+    return name is None or "server" in name
+
+
+def resolve_model_config():
+    """
+    Résout les dossiers modèles et l'usage de oneDNN, puis pose
+    FLAGS_use_mkldnn — à appeler AVANT l'import de paddle (flag lu à l'import).
+
+    - OCR_MKLDNN=auto : oneDNN actif sauf avec le détecteur PP-OCRv5 server, qui
+      crash avec "ConvertPirAttribute2RuntimeAttribute not support
+      [pir::ArrayAttribute<pir::DoubleAttribute>]". Les variantes mobile gardent
+      les convolutions/GEMM oneDNN.
+
+    Retourne (det_dir, rec_dir, cls_dir, use_mkldnn).
+    """
+    det_dir = os.getenv("PPOCR_DET_DIR", "/models/ppocrv5/det")
+    rec_dir = os.getenv("PPOCR_REC_DIR", "/models/ppocrv5/rec")
+    cls_dir = os.getenv("PPOCR_CLS_DIR", "/models/ppocrv5/cls")
+
+    mode = os.getenv("OCR_MKLDNN", "auto")
+    if mode in ("0", "1"):
+        use_mkldnn = mode == "1"
+    else:
+        use_mkldnn = not _is_server_model(det_dir)
+
+    os.environ["FLAGS_use_mkldnn"] = "1" if use_mkldnn else "0"
+    return det_dir, rec_dir, cls_dir, use_mkldnn
+
+
 def load_model(lang: str = "fr"):
     """
     Charge PaddleOCR en restant compatible avec plusieurs versions :
@@ -60,6 +142,11 @@ def load_model(lang: str = "fr"):
 
     Si des modèles custom (PP-OCRv5) sont présents dans /models/ppocrv5,
     on force les chemins pour éviter tout téléchargement à l'exécution.
+
+    oneDNN : voir resolve_model_config().
+
+    OCR_BACKEND=hpi active enable_hpi (nouvelle API uniquement) : PaddleX choisit
+    le backend le plus rapide disponible (OpenVINO / ONNX Runtime sur CPU).
     """
     _orig_print(
         f"[worker pid={os.getpid()}] Loading PaddleOCR model (lang={lang})...",
@@ -67,11 +154,18 @@ def load_model(lang: str = "fr"):
         flush=True,
     )
 
-    from paddleocr import PaddleOCR
+    det_dir, rec_dir, cls_dir, use_mkldnn = resolve_model_config()
+    backend = os.getenv("OCR_BACKEND", "paddle")
+    if backend not in ("paddle", "hpi"):
+        raise ValueError(f"Invalid OCR_BACKEND: {backend!r} (expected 'paddle' or 'hpi')")
+    _orig_print(
+        f"[worker pid={os.getpid()}] backend={backend} "
+        f"oneDNN={'on' if use_mkldnn else 'off'}",
+        file=sys.stderr,
+        flush=True,
+    )
 
-    det_dir = os.getenv("PPOCR_DET_DIR", "/models/ppocrv5/det")
-    rec_dir = os.getenv("PPOCR_REC_DIR", "/models/ppocrv5/rec")
-    cls_dir = os.getenv("PPOCR_CLS_DIR", "/models/ppocrv5/cls")
+    from paddleocr import PaddleOCR
 
     have_custom = all(os.path.isdir(p) for p in (det_dir, rec_dir, cls_dir))
 
@@ -91,7 +185,13 @@ def load_model(lang: str = "fr"):
 
     # ── Essai prioritaire : nouvelle API paddleocr >= 3.4.0 ──────────────────
     try:
-        kwargs = dict(lang=lang, use_textline_orientation=True, device="cpu")
+        kwargs = dict(
+            lang=lang, use_textline_orientation=True, device="cpu", enable_mkldnn=use_mkldnn
+        )
+        if backend == "hpi":
+            kwargs.update(enable_hpi=True)
+        if not _doc_preprocess():
+            kwargs.update(use_doc_orientation_classify=False, use_doc_unwarping=False)
         if have_custom:
             kwargs.update(
                 text_detection_model_dir=det_dir,
@@ -100,12 +200,21 @@ def load_model(lang: str = "fr"):
             )
         model = PaddleOCR(**kwargs)
         _orig_print(f"[worker pid={os.getpid()}] Ready (new API).", file=sys.stderr, flush=True)
+        warmup_model(model)
+        if have_custom and os.getenv("OCR_DPI_POLICY", "fixed") == "adaptive":
+            load_probe_detector(det_dir, use_mkldnn)
         return model
     except TypeError:
         pass  # paramètres inconnus → on tente l'ancienne API
 
     # ── Fallback : ancienne API paddleocr < 3.4.0 ────────────────────────────
-    kwargs = dict(lang=lang, use_angle_cls=True, use_gpu=False)
+    if backend != "paddle":
+        _orig_print(
+            f"[worker pid={os.getpid()}] OCR_BACKEND={backend} unsupported by legacy API; using Paddle.",
+            file=sys.stderr,
+            flush=True,
+        )
+    kwargs = dict(lang=lang, use_angle_cls=True, use_gpu=False, enable_mkldnn=use_mkldnn)
     if have_custom:
         kwargs.update(
             det_model_dir=det_dir,
@@ -114,9 +223,47 @@ def load_model(lang: str = "fr"):
         )
     model = PaddleOCR(**kwargs)
     _orig_print(f"[worker pid={os.getpid()}] Ready (legacy API).", file=sys.stderr, flush=True)
+    warmup_model(model)
     return model
 
 
+# Formats de pages pré-chauffés (H, W) : carré du détecteur, paysage, A4 ~110 DPI
+_WARMUP_SHAPES = ((640, 640), (320, 640), (1280, 960))
+
+
+def warmup_model(model) -> None:
+    """
+    Inférences factices avant {"ready": true} : Paddle alloue ses buffers et
+    crée ses primitives oneDNN au premier appel de chaque forme d'entrée —
+    coût payé au démarrage plutôt que par la première requête.
+
+    Pages blanches barrées de quelques traits noirs, pour que la reconnaissance
+    tourne aussi (une page vide ne produit aucune boîte). OCR_WARMUP=0 : désactivé.
+    """
+    if os.getenv("OCR_WARMUP", "1") != "1":
+        return
+    import time
+
+    import numpy as np
+
+    t0 = time.monotonic()
+    for h, w in _WARMUP_SHAPES:
+        page = np.full((h, w), 255, dtype=np.uint8)
+        for y in range(h // 8, h - 40, h // 4):
+            page[y:y + 24, w // 10:w - w // 10] = 0
+        try:
+            ocr_images(model, [page])
+        except Exception as e:
+            # Non bloquant : la première vraie requête paiera l'initialisation
+            _orig_print(f"[worker pid={os.getpid()}] Warm-up failed: {e}", file=sys.stderr, flush=True)
+            return
+    _orig_print(
+        f"[worker pid={os.getpid()}] Warm-up done in {time.monotonic() - t0:.1f}s",
+        file=sys.stderr,
+        flush=True,
+    )
+
+
 # ── OCR call compatible ──────────────────────────────────────────────────────
 
 def ocr_image(model, img):
@@ -131,67 +278,768 @@ def ocr_image(model, img):
         return model.ocr(img)
 
 
+def _model_input(img):
+    """
+    PaddleOCR attend 3 canaux : une page en niveaux de gris (H, W) est étendue
+    en (H, W, 3) par une vue à pas nul (np.broadcast_to), sans copie.
+    """
+    if img.ndim == 2:
+        import numpy as np
+
+        return np.broadcast_to(img[:, :, None], img.shape + (3,))
+    return img
+
+
+def ocr_images(model, imgs, raw_coords: bool = False):
+    """
+    OCR d'un lot d'images -> une entrée de résultat par image.
+
+    - paddleocr >= 3.x : predict() accepte une liste → un seul appel batché
+      (détection / orientation / reconnaissance en tenseurs groupés)
+    - paddleocr < 3.x  : ocr() refuse les listes avec det=True → image par image
+
+    raw_coords : sans le préprocesseur document de paddleocr 3.x (orientation,
+    redressement UVDoc), qui renvoie des boîtes dans le repère de l'image
+    transformée — et qui traiterait chaque bande d'une page comme un document.
+    """
+    imgs = [_model_input(img) for img in imgs]
+    kwargs = {}
+    if raw_coords:
+        kwargs = dict(use_doc_orientation_classify=False, use_doc_unwarping=False)
+    with _MODEL_LOCK:
+        if (len(imgs) > 1 or raw_coords) and hasattr(model, "predict"):
+            try:
+                results = list(model.predict(list(imgs), **kwargs))
+                if len(results) == len(imgs):
+                    return results
+            except TypeError:
+                pass  # API trop ancienne → fallback image par image
+
+        results = []
+        for img in imgs:
+            result = ocr_image(model, img)
+            results.append(result[0] if result else None)
+        return results
+
+
+def _page_lines(res_page):
+    """Extrait les lignes de texte du résultat PaddleOCR d'une image."""
+    if not res_page:
+        return []
+    if isinstance(res_page, dict):
+        # paddleocr >= 3.x : liste plate de chaînes, pas d'indexation par ligne
+        return [t for t in res_page.get("rec_texts", []) if t]
+    # Structure commune: [ [box], (text, score) ], ...
+    return [text for text in (line[1][0].strip() for line in res_page) if text]
+
+
+def _page_entries(res_page):
+    """(box, texte) de chaque ligne reconnue — box = polygone [(x, y), ...]."""
+    if not res_page:
+        return []
+    if isinstance(res_page, dict):
+        # paddleocr >= 3.x : rec_polys et rec_texts sont alignés
+        polys = res_page.get("rec_polys")
+        return list(zip(polys if polys is not None else [], res_page.get("rec_texts", [])))
+    # Structure commune: [ [box], (text, score) ], ...
+    return [(line[0], line[1][0].strip()) for line in res_page]
+
+
 # ── OCR PDF ──────────────────────────────────────────────────────────────────
 
-def ocr_pdf(model, pdf_path: str, dpi: int = 300):
-    """Convertit un PDF en texte via PaddleOCR (page par page)."""
+_RENDER_DONE = object()
+
+# Plafond mémoire d'un lot de pages en attente d'inférence
+_BATCH_MAX_BYTES = 256 * 1024 * 1024
+
+# Une page dont la couche texte native dépasse ce seuil n'est pas OCRisée
+_NATIVE_TEXT_MIN_CHARS = 40
+
+# ... sauf si des images couvrent une telle part de la page : scan surmonté d'un
+# tampon / pied de page texte → la couche texte ne représente pas le contenu
+_NATIVE_TEXT_MAX_IMAGE_COVER = 0.5
+
+# ... ou si la couche texte est illisible : police sans table ToUnicode → U+FFFD,
+# caractères de contrôle ou zone privée à la place du texte
+_NATIVE_TEXT_MAX_GARBLED = 0.3
+
+# Pages très grandes (ex. A4 300 DPI ≈ 8.7 MP) : découpées en 2-4 bandes
+# horizontales qui se recouvrent, envoyées en lot au prédicteur. Seulement sans
+# préprocesseur document (OCR_DOC_PREPROCESS=0) : l'orientation / le redressement
+# valent pour la page entière, pas pour une bande isolée.
+_TILE_MAX_PIXELS = 6_000_000
+_TILE_MAX_STRIPS = 4
+_TILE_OVERLAP = 64
+
+# DPI adaptatif : la 1re page à OCRiser est sondée à basse résolution (détecteur
+# seul), puis on choisit le DPI qui amène la hauteur médiane des lignes vers la cible.
+_ADAPTIVE_PROBE_DPI = 150
+_ADAPTIVE_TARGET_LINE_PX = 32
+_ADAPTIVE_MIN_DPI = 150
+_ADAPTIVE_MAX_DPI = 300
+
+
+def _render_page(doc, page_index: int, zoom: float, gray: bool = False, pdf=None):
+    """
+    Rasterise une page PDF -> (img, pix) : img est une vue numpy sur la mémoire
+    du bitmap, sans copie — RGB (H, W, 3), ou (H, W) si `gray`. pix (pixmap
+    PyMuPDF ou bitmap PDFium) doit rester référencé tant que img est utilisé :
+    la vue ne garde pas le bitmap natif vivant.
+
+    `pdf` : document pypdfium2 → rendu PDFium ; None → rendu PyMuPDF sur `doc`.
+    """
+    if pdf is not None:
+        return _render_page_pdfium(pdf, page_index, zoom, gray=gray)
+
     import fitz  # PyMuPDF
     import numpy as np
 
-    doc = fitz.open(pdf_path)
-    page_count = len(doc)
-    pages_text = []
+    with _FITZ_LOCK:
+        page = doc.load_page(page_index)
+
+        # Render page -> pixmap (sans alpha). En niveaux de gris, PyMuPDF rend
+        # directement 1 canal : 3x moins d'octets à produire, garder et lire.
+        colorspace = fitz.csGRAY if gray else fitz.csRGB
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False, colorspace=colorspace)
+
+    # pix.samples_mv = memoryview sur les échantillons (pix.samples copierait en bytes)
+    img = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+    if pix.n == 1:
+        return img[:, :, 0], pix
+
+    # IMPORTANT:
+    # - pix.get_pixmap(alpha=False) renvoie généralement du RGB (n==3)
+    # - PaddleOCR accepte des numpy arrays.
+    # Si tu veux absolument du BGR (sans OpenCV), tu peux inverser les canaux :
+    # img = img[:, :, ::-1]
+    #
+    # Ici on garde RGB pour éviter OpenCV (souvent source de crash quand les wheels opencv se mélangent).
+    if pix.n == 4:
+        # Sécurité si jamais (devrait être rare avec alpha=False)
+        img = img[:, :, :3]
+
+    return img, pix
+
+
+def _render_page_pdfium(pdf, page_index: int, zoom: float, gray: bool = False):
+    """
+    Rendu PDFium (pypdfium2) -> (img, bitmap). Le rendu natif s'exécute hors
+    GIL : l'OCR du lot précédent continue pendant ce temps.
+    """
+    with _PDFIUM_LOCK:
+        page = pdf[page_index]
+        try:
+            # rev_byteorder : PDFium produit du BGR par défaut → RGB directement
+            bitmap = page.render(scale=zoom, grayscale=gray, rev_byteorder=not gray)
+        finally:
+            page.close()
+
+    img = bitmap.to_numpy()  # (H, W, n), lignes éventuellement alignées (stride)
+    if img.shape[2] == 1:
+        return img[:, :, 0], bitmap
+    return img[:, :, :3], bitmap
+
+
+def _release_bitmaps(bitmaps) -> None:
+    """
+    Libère les bitmaps PDFium sous _PDFIUM_LOCK : pypdfium2 n'admet aucun
+    appel PDFium concurrent, destruction comprise (le producteur rend en
+    parallèle). Sans effet sur les pixmaps PyMuPDF (libérés par le GC).
+    """
+    bitmaps = [b for b in bitmaps if hasattr(b, "close")]
+    if not bitmaps:
+        return
+    with _PDFIUM_LOCK:
+        for bitmap in bitmaps:
+            bitmap.close()
+
+
+def _open_rasterizer(pdf_path: str):
+    """
+    Document pypdfium2 si OCR_RASTERIZER=pdfium, sinon None (PyMuPDF, défaut :
+    plus rapide que PDFium à tous les formats mesurés — texte, images, gris, RGB).
+    Sans pypdfium2 installé, retombe sur PyMuPDF.
+    """
+    rasterizer = os.getenv("OCR_RASTERIZER", "mupdf")
+    if rasterizer not in ("pdfium", "mupdf"):
+        raise ValueError(f"Invalid OCR_RASTERIZER: {rasterizer!r} (expected 'pdfium' or 'mupdf')")
+    if rasterizer == "mupdf":
+        return None
+    try:
+        import pypdfium2 as pdfium
+    except ImportError:
+        _orig_print(
+            f"[worker pid={os.getpid()}] pypdfium2 not installed; rendering with PyMuPDF.",
+            file=sys.stderr,
+            flush=True,
+        )
+        return None
+    with _PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(pdf_path)
+        # Sans init_forms, PDFium ne dessine pas les champs AcroForm remplis
+        # (PyMuPDF les rend) : valeurs saisies perdues sur les formulaires
+        pdf.init_forms()
+    return pdf
+
+
+def _doc_preprocess() -> bool:
+    """Orientation / redressement de page de paddleocr 3.x actifs (OCR_DOC_PREPROCESS)."""
+    return os.getenv("OCR_DOC_PREPROCESS", "1") == "1"
+
+
+def _tile_page(img):
+    """
+    Découpe une page trop grande en bandes horizontales (vues, sans copie).
+    Retourne [(y0, keep_from, keep_to, strip)] : la bande commence à la ligne
+    y0 de la page, et n'en garde que les lignes de texte dont le centre tombe
+    dans [keep_from, keep_to). Chaque bande déborde de _TILE_OVERLAP px sur
+    ses voisines, de sorte qu'une ligne coupée par une frontière soit entière
+    dans la bande qui la garde.
+    """
+    height, width = img.shape[:2]
+    if height * width <= _TILE_MAX_PIXELS:
+        return [(0, 0, height, img)]
+
+    n = min(_TILE_MAX_STRIPS, -(-height * width // _TILE_MAX_PIXELS))
+    bounds = [round(i * height / n) for i in range(n + 1)]
+    tiles = []
+    for top, bottom in zip(bounds, bounds[1:]):
+        y0 = max(0, top - _TILE_OVERLAP)
+        y1 = min(height, bottom + _TILE_OVERLAP)
+        tiles.append((y0, top, bottom, img[y0:y1]))
+    return tiles
+
 
-    # DPI -> zoom (PDF est en 72 DPI de base)
-    zoom = dpi / 72.0
-    mat = fitz.Matrix(zoom, zoom)
+def _merge_tiles(tiles, results):
+    """Recolle les lignes des bandes d'une page (ordre haut → bas, sans doublons)."""
+    if len(tiles) == 1:
+        return _page_lines(results[0])
+    lines = []
+    for (y0, keep_from, keep_to, _), res_page in zip(tiles, results):
+        for box, text in _page_entries(res_page):
+            ys = [pt[1] for pt in box]
+            center = y0 + (min(ys) + max(ys)) / 2.0
+            if text and keep_from <= center < keep_to:
+                lines.append(text)
+    return lines
 
-    for page_index in range(page_count):
+
+def _garbled_ratio(text: str) -> float:
+    """Part des caractères visibles qui sont U+FFFD ou non imprimables (contrôle, zone privée…)."""
+    visible = bad = 0
+    for c in text:
+        if c.isspace():
+            continue
+        visible += 1
+        if c == "\ufffd" or not c.isprintable():
+            bad += 1
+    return bad / visible if visible else 1.0
+
+
+def _native_text(doc, page_index: int):
+    """
+    Texte embarqué de la page (PDF numérique), ou None si la page doit être
+    OCRisée (scan, image seule, texte trop court pour être fiable, texte
+    illisible, ou images couvrant une grande part de la page).
+    """
+    with _FITZ_LOCK:
         page = doc.load_page(page_index)
+        text = page.get_text("text").strip()
+        if len(text) < _NATIVE_TEXT_MIN_CHARS:
+            return None
+        # get_image_info : emprises des images sans extraire leurs données
+        rect = page.rect
+        images = [info["bbox"] for info in page.get_image_info()]
+    if _garbled_ratio(text) >= _NATIVE_TEXT_MAX_GARBLED:
+        return None
+    page_area = rect.width * rect.height
+    if page_area > 0 and images:
+        covered = 0.0
+        for x0, y0, x1, y1 in images:
+            w = min(x1, rect.x1) - max(x0, rect.x0)
+            h = min(y1, rect.y1) - max(y0, rect.y0)
+            if w > 0 and h > 0:
+                covered += w * h
+        if covered / page_area >= _NATIVE_TEXT_MAX_IMAGE_COVER:
+            return None
+    return text
+
+
+def _iter_rendered_pages(
+    doc, zoom, prefetch: int = 2, skip_native: bool = False, gray: bool = False, pdf=None
+):
+    """
+    Génère (page_index, img, pix, native_text) dans l'ordre des pages ;
+    pix est le pixmap qui porte la mémoire de img (à garder avec img).
+
+    Avec `skip_native`, une page qui a déjà une couche texte exploitable
+    n'est pas rasterisée : img/pix valent None et native_text contient le
+    texte. Sinon native_text vaut None.
+
+    La rasterisation tourne dans un thread producteur (PyMuPDF relâche le GIL
+    pendant le rendu) : la page suivante est rendue pendant que PaddleOCR
+    traite la page courante. La file est bornée pour limiter la RAM.
+    Seul le thread producteur touche `doc` tant que le générateur est actif.
+    Avec `pdf` (document pypdfium2), les pages sont rendues par PDFium ; `doc`
+    ne sert plus qu'à la couche texte et au nombre de pages.
+    """
+    pages = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for page_index in range(len(doc)):
+                if stop.is_set():
+                    return
+                native = _native_text(doc, page_index) if skip_native else None
+                if native is not None:
+                    pages.put((page_index, None, None, native))
+                else:
+                    img, pix = _render_page(doc, page_index, zoom, gray=gray, pdf=pdf)
+                    pages.put((page_index, img, pix, None))
+        except Exception as e:
+            pages.put(e)
+        finally:
+            pages.put(_RENDER_DONE)
+
+    producer = threading.Thread(target=produce, name="pdf-render", daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item = pages.get()
+            if item is _RENDER_DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Arrêt anticipé (erreur OCR, générateur fermé) : on vide la file
+        # pour débloquer le producteur avant de rendre la main (doc.close()).
+        stop.set()
+        dropped = []
+        while producer.is_alive():
+            try:
+                dropped.append(pages.get(timeout=0.1))
+            except queue.Empty:
+                pass
+        producer.join()
+        while not pages.empty():
+            dropped.append(pages.get_nowait())
+        _release_bitmaps(item[2] for item in dropped if isinstance(item, tuple))
+
+
+def _box_heights(res_page):
+    """Hauteurs (px) des boîtes de texte détectées sur une image."""
+    if not res_page:
+        return []
+    if isinstance(res_page, dict):
+        # paddleocr >= 3.x : OCRResult (dict) avec les polygones détectés
+        polys = res_page.get("rec_polys")
+        if polys is None:
+            polys = res_page.get("dt_polys")
+        boxes = polys if polys is not None else []
+    else:
+        # Structure commune: [ [box], (text, score) ], ...
+        boxes = [line[0] for line in res_page]
+    heights = []
+    for box in boxes:
+        ys = [pt[1] for pt in box]
+        heights.append(float(max(ys) - min(ys)))
+    return [h for h in heights if h > 0]
+
+
+# Détecteur seul pour la sonde du DPI adaptatif — chargé par load_model()
+# uniquement si OCR_DPI_POLICY=adaptive (sinon : sonde par le pipeline complet)
+_DETECTOR = None
+
+
+def load_probe_detector(det_dir: str, use_mkldnn: bool) -> None:
+    """
+    Charge et pré-chauffe paddleocr.TextDetection (3.x) sur le dossier du
+    pipeline, avec les réglages déjà résolus par load_model() : la sonde ne
+    fait ni orientation ni reconnaissance. Coût : une copie des poids du
+    détecteur par worker, d'où l'activation liée à OCR_DPI_POLICY=adaptive.
+    Échec → _DETECTOR reste None (sonde par le pipeline complet).
+    """
+    global _DETECTOR
+    name = _model_name(det_dir)
+    if name is None:
+        return
+    try:
+        import numpy as np
+        from paddleocr import TextDetection
+
+        detector = TextDetection(
+            model_name=name, model_dir=det_dir, device="cpu", enable_mkldnn=use_mkldnn
+        )
+        list(detector.predict(np.full((640, 640, 3), 255, dtype=np.uint8)))
+    except Exception as e:
+        _orig_print(
+            f"[worker pid={os.getpid()}] Detector-only probe unavailable ({e}); "
+            "probing with the full pipeline.",
+            file=sys.stderr,
+            flush=True,
+        )
+        return
+    _DETECTOR = detector
+
+
+def _probe_boxes(model, img):
+    """Résultat de détection d'une image (dt_polys), via le détecteur seul si chargé."""
+    if _DETECTOR is None:
+        return ocr_images(model, [img])[0]
+    with _MODEL_LOCK:
+        return next(iter(_DETECTOR.predict(_model_input(img))), None)
+
+
+def pick_adaptive_dpi(
+    model, doc, default_dpi: int, gray: bool = False, pdf=None, skip_native: bool = False
+) -> int:
+    """
+    Choisit le DPI d'un document d'après la taille de son texte :
+    la première page à OCRiser (pas de couche texte native si `skip_native`)
+    est rendue à 150 DPI, on mesure la hauteur médiane des lignes détectées
+    (détecteur seul) et on vise ~32 px par ligne au DPI final (borné à 150-300).
+    Sans page à OCRiser ou sans texte détecté, on garde `default_dpi`.
+    """
+    probe_index = None
+    for page_index in range(len(doc)):
+        if not skip_native or _native_text(doc, page_index) is None:
+            probe_index = page_index
+            break
+    if probe_index is None:
+        return default_dpi
+
+    zoom = _ADAPTIVE_PROBE_DPI / 72.0
+    thumb, pix = _render_page(doc, probe_index, zoom, gray=gray, pdf=pdf)
+    try:
+        heights = _box_heights(_probe_boxes(model, thumb))
+    finally:
+        del thumb
+        _release_bitmaps([pix])
+    if not heights:
+        return default_dpi
+
+    dpi = _ADAPTIVE_PROBE_DPI * _ADAPTIVE_TARGET_LINE_PX / statistics.median(heights)
+    dpi = int(round(dpi / 10.0) * 10)
+    return max(_ADAPTIVE_MIN_DPI, min(_ADAPTIVE_MAX_DPI, dpi))
+
+
+def iter_pdf_pages(
+    model,
+    pdf_path: str,
+    dpi: int = 200,
+    batch_size: int = 4,
+    dpi_policy: str = "fixed",
+    skip_native: bool = True,
+    gray: bool = False,
+    preproc: str = None,
+    tile: bool = False,
+):
+    """
+    Génère (page_index, texte) dans l'ordre des pages, au fil de l'OCR
+    (pages traitées par lots). Les pages qui ont une couche texte native la
+    réutilisent sans OCR. preproc="binarize" : pages seuillées en noir/blanc
+    avant inférence (ocr_preproc, Numba). tile : très grandes pages découpées
+    en bandes (préprocesseur document inactif). Rendu : voir _open_rasterizer().
+    """
+    import fitz  # PyMuPDF
+
+    binarize = None
+    if preproc == "binarize":
+        from ocr_preproc import binarize
+
+    with _FITZ_LOCK:
+        doc = fitz.open(pdf_path)
+    pdf = None
+    pages = None
+    batch = []  # [(page_index, img, pix)]
+    try:
+        pdf = _open_rasterizer(pdf_path)
+        if dpi_policy == "adaptive":
+            dpi = pick_adaptive_dpi(model, doc, dpi, gray=gray, pdf=pdf, skip_native=skip_native)
+            _orig_print(
+                f"[worker pid={os.getpid()}] Adaptive DPI: {dpi}",
+                file=sys.stderr,
+                flush=True,
+            )
+
+        # DPI -> zoom (PDF est en 72 DPI de base)
+        zoom = dpi / 72.0
+
+        done = {}  # page_index -> texte, en attente des pages précédentes
+        next_index = 0
+
+        def flush():
+            # Pages entières du lot → un appel ; bandes des pages découpées → un
+            # second appel, en coordonnées brutes (nécessaires pour les recoller)
+            whole = []  # (page_index, img)
+            strips = []
+            spans = []  # (page_index, tiles, index de la 1re bande dans strips)
+            for page_index, img, _ in batch:
+                if binarize is not None:
+                    img = binarize(img)
+                tiles = _tile_page(img) if tile else [(0, 0, img.shape[0], img)]
+                if len(tiles) == 1:
+                    whole.append((page_index, img))
+                else:
+                    spans.append((page_index, tiles, len(strips)))
+                    strips.extend(tile[3] for tile in tiles)
+            if whole:
+                results = ocr_images(model, [img for _, img in whole])
+                for (page_index, _), res_page in zip(whole, results):
+                    done[page_index] = "\n".join(_page_lines(res_page))
+            if strips:
+                results = ocr_images(model, strips, raw_coords=True)
+                for page_index, tiles, start in spans:
+                    lines = _merge_tiles(tiles, results[start:start + len(tiles)])
+                    done[page_index] = "\n".join(lines)
+            _release_bitmaps(pix for _, _, pix in batch)
+            batch.clear()
 
-        # Render page -> pixmap (sans alpha)
-        pix = page.get_pixmap(matrix=mat, alpha=False)
-
-        # pix.samples = bytes
-        img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
-
-        # IMPORTANT:
-        # - pix.get_pixmap(alpha=False) renvoie généralement du RGB (n==3)
-        # - PaddleOCR accepte des numpy arrays.
-        # Si tu veux absolument du BGR (sans OpenCV), tu peux inverser les canaux :
-        # img = img[:, :, ::-1]
-        #
-        # Ici on garde RGB pour éviter OpenCV (souvent source de crash quand les wheels opencv se mélangent).
-        if pix.n == 4:
-            # Sécurité si jamais (devrait être rare avec alpha=False)
-            img = img[:, :, :3]
-
-        result = ocr_image(model, img)
-
-        lines = []
-        # PaddleOCR renvoie typiquement une liste par image
-        # Structure commune: [[ [box], (text, score) ], ...]
-        if result:
-            for res_page in result:
-                if not res_page:
-                    continue
-                for line in res_page:
-                    try:
-                        text = line[1][0].strip()
-                    except Exception:
-                        continue
-                    if text:
-                        lines.append(text)
-
-        pages_text.append("\n".join(lines))
-
-    doc.close()
-    full_text = "\n\n--- PAGE BREAK ---\n\n".join(pages_text).strip()
-    return full_text, page_count
+        pages = _iter_rendered_pages(doc, zoom, skip_native=skip_native, gray=gray, pdf=pdf)
+        for page_index, img, pix, native in pages:
+            if img is None:
+                done[page_index] = native
+            else:
+                batch.append((page_index, img, pix))
+                # Lot plein, ou RAM des pages en attente trop élevée → inférence
+                if len(batch) >= batch_size or sum(i.nbytes for _, i, _ in batch) > _BATCH_MAX_BYTES:
+                    flush()
+            while next_index in done:
+                yield next_index, done.pop(next_index)
+                next_index += 1
+        if batch:
+            flush()
+        while next_index in done:
+            yield next_index, done.pop(next_index)
+            next_index += 1
+    finally:
+        # Le producteur doit être arrêté avant de fermer le document
+        if pages is not None:
+            pages.close()
+        _release_bitmaps(pix for _, _, pix in batch)
+        if pdf is not None:
+            with _PDFIUM_LOCK:
+                pdf.close()
+        with _FITZ_LOCK:
+            doc.close()
+
+
+def join_pages(pages_text) -> str:
+    return "\n\n--- PAGE BREAK ---\n\n".join(pages_text).strip()
+
+
+def ocr_pdf(model, pdf_path: str, **opts):
+    """Convertit un PDF en texte via PaddleOCR -> (texte complet, nb de pages)."""
+    pages_text = [text for _, text in iter_pdf_pages(model, pdf_path, **opts)]
+    return join_pages(pages_text), len(pages_text)
+
+
+# ── Cache des résultats ──────────────────────────────────────────────────────
+# Partagé entre workers (fichiers JSON, écriture atomique tmp + rename).
+
+_CACHE_FORMAT = 2
+
+
+def cache_key(pdf_path: str, **opts) -> str:
+    """Clé = BLAKE3(contenu du PDF) + options qui influencent le texte produit."""
+    import blake3
+
+    h = blake3.blake3()
+    with open(pdf_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    opts_str = ":".join(f"{k}={v}" for k, v in sorted(opts.items()))
+    return blake3.blake3(f"{h.hexdigest()}:{opts_str}:v{_CACHE_FORMAT}".encode()).hexdigest()
+
+
+def model_fingerprint() -> str:
+    """
+    Empreinte du modèle effectivement chargé, pour la clé de cache : version
+    de paddleocr, config (inference.yml) et taille des poids de chaque dossier
+    modèle, oneDNN et backend. Un changement d'image / de modèles invalide
+    ainsi les résultats d'un volume de cache persistant.
+    """
+    import blake3
+    from importlib.metadata import PackageNotFoundError, version
+
+    det_dir, rec_dir, cls_dir, use_mkldnn = resolve_model_config()
+    h = blake3.blake3()
+    try:
+        h.update(f"paddleocr={version('paddleocr')}".encode())
+    except PackageNotFoundError:
+        pass
+    h.update(f":mkldnn={use_mkldnn}:backend={os.getenv('OCR_BACKEND', 'paddle')}".encode())
+    for model_dir in (det_dir, rec_dir, cls_dir):
+        h.update(f":{model_dir}".encode())
+        for name in ("inference.yml", "inference.pdiparams"):
+            path = os.path.join(model_dir, name)
+            try:
+                if name.endswith(".yml"):
+                    with open(path, "rb") as f:
+                        h.update(f.read())
+                else:
+                    h.update(str(os.path.getsize(path)).encode())
+            except OSError:
+                h.update(b"-")
+    return h.hexdigest()[:16]
+
+
+def cache_get(cache_dir: str, key: str):
+    """Résultat en cache (dict) ou None. Un hit rafraîchit le mtime (LRU)."""
+    path = os.path.join(cache_dir, f"{key}.json")
+    try:
+        with open(path, "rb") as f:
+            payload = orjson.loads(f.read())
+        os.utime(path)
+        return payload
+    except (OSError, orjson.JSONDecodeError):
+        return None
+
+
+def cache_put(cache_dir: str, key: str, payload: dict, max_bytes: int) -> None:
+    """Écrit le résultat puis évince les entrées les plus anciennes au-delà de max_bytes."""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"{key}.json")
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps(payload))
+    os.replace(tmp, path)
+
+    entries = []
+    total = 0
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.name.endswith(".json"):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+    if total <= max_bytes:
+        return
+    for _mtime, size, old in sorted(entries):
+        try:
+            os.unlink(old)
+        except OSError:
+            continue
+        total -= size
+        if total <= max_bytes:
+            break
 
 
 # ── Boucle principale ─────────────────────────────────────────────────────────
 
+def handle_request(
+    model, raw_line: bytes, cache_dir: str, cache_max_bytes: int, model_id: str = ""
+) -> None:
+    """Traite une ligne de requête et émet la (ou les) réponse(s) correspondante(s)."""
+    req_id = None
+    try:
+        req = orjson.loads(raw_line)
+        req_id = req.get("id")
+        pdf_path = req["pdf_path"]
+
+        # DPI configurable depuis la requête (fallback env OCR_DPI puis 200)
+        dpi = int(req.get("dpi", os.getenv("OCR_DPI", 200)))
+        dpi_policy = req.get("dpi_policy", os.getenv("OCR_DPI_POLICY", "fixed"))
+        if dpi_policy not in ("fixed", "adaptive"):
+            raise ValueError(f"Invalid dpi_policy: {dpi_policy!r} (expected 'fixed' or 'adaptive')")
+        preproc = req.get("preproc")
+        if preproc not in (None, "binarize"):
+            raise ValueError(f"Invalid preproc: {preproc!r} (expected 'binarize')")
+
+        batch_size = max(1, int(os.getenv("OCR_BATCH", 4)))
+        skip_native = os.getenv("OCR_SKIP_NATIVE_TEXT", "1") == "1"
+        gray = os.getenv("OCR_GRAYSCALE", "1") == "1"
+        doc_preprocess = _doc_preprocess()
+        stream = bool(req.get("stream", False))
+
+        key = None
+        if cache_dir and req.get("use_cache", True):
+            key = cache_key(
+                pdf_path,
+                dpi=dpi,
+                dpi_policy=dpi_policy,
+                skip_native=skip_native,
+                gray=gray,
+                preproc=preproc,
+                doc_preprocess=doc_preprocess,
+                rasterizer=os.getenv("OCR_RASTERIZER", "mupdf"),
+                lang=os.getenv("OCR_LANG", "fr"),
+                model=model_id,
+            )
+            cached = cache_get(cache_dir, key)
+        else:
+            cached = None
+
+        if cached is not None:
+            pages = enumerate(cached["pages"])
+        else:
+            pages = iter_pdf_pages(
+                model,
+                pdf_path,
+                dpi=dpi,
+                batch_size=batch_size,
+                dpi_policy=dpi_policy,
+                skip_native=skip_native,
+                gray=gray,
+                preproc=preproc,
+                tile=not doc_preprocess,
+            )
+
+        # En streaming sans cache, le texte n'est pas conservé (RAM constante)
+        keep_text = not stream or (key is not None and cached is None)
+        pages_text = []
+        page_count = 0
+        for page_index, text in pages:
+            if stream:
+                emit({"id": req_id, "page": page_index, "partial_text": text})
+            if keep_text:
+                pages_text.append(text)
+            page_count += 1
+
+        if stream:
+            emit({"id": req_id, "done": True, "page_count": page_count})
+        else:
+            emit({"id": req_id, "text": join_pages(pages_text), "page_count": page_count})
+
+        if key is not None and cached is None:
+            try:
+                cache_put(cache_dir, key, {"pages": pages_text}, cache_max_bytes)
+            except OSError as e:
+                _orig_print(
+                    f"[worker pid={os.getpid()}] Cache write failed: {e}",
+                    file=sys.stderr,
+                    flush=True,
+                )
+
+    except orjson.JSONDecodeError as e:
+        emit({"id": req_id, "error": f"Invalid JSON: {e}"})
+    except KeyError as e:
+        emit({"id": req_id, "error": f"Missing field: {e}"})
+    except Exception as e:
+        _orig_print(traceback.format_exc(), file=sys.stderr, flush=True)
+        emit({"id": req_id, "error": str(e)})
+
+
+def _log_request_failure(fut) -> None:
+    """
+    Done-callback des requêtes : une exception sortie de handle_request (ex.
+    emit sur un stdout fermé) resterait sinon muette dans la Future.
+    """
+    if fut.cancelled():
+        return
+    exc = fut.exception()
+    if exc is not None:
+        _orig_print(
+            f"[worker pid={os.getpid()}] Request failed:\n"
+            + "".join(traceback.format_exception(exc)),
+            file=sys.stderr,
+            flush=True,
+        )
+
+
 def main():
     try:
         model = load_model(lang=os.getenv("OCR_LANG", "fr"))
@@ -199,32 +1047,26 @@ def main():
         emit({"ready": False, "error": f"Model load failed: {e}"})
         sys.exit(1)
 
-    emit({"ready": True})
-
-    for raw_line in sys.stdin:
-        raw_line = raw_line.strip()
-        if not raw_line:
-            continue
-
-        req_id = None
-        try:
-            req = json.loads(raw_line)
-            req_id = req.get("id")
-            pdf_path = req["pdf_path"]
-
-            # DPI configurable depuis la requête (fallback env OCR_DPI puis 300)
-            dpi = int(req.get("dpi", os.getenv("OCR_DPI", 300)))
+    cache_dir = os.getenv("OCR_CACHE_DIR", "/var/cache/ocr")
+    cache_max_bytes = int(os.getenv("OCR_CACHE_MAX_MB", 1024)) * 1024 * 1024
+    model_id = model_fingerprint() if cache_dir else ""
 
-            text, page_count = ocr_pdf(model, pdf_path, dpi=dpi)
-            emit({"id": req_id, "text": text, "page_count": page_count})
+    emit({"ready": True})
 
-        except json.JSONDecodeError as e:
-            emit({"id": req_id, "error": f"Invalid JSON: {e}"})
-        except KeyError as e:
-            emit({"id": req_id, "error": f"Missing field: {e}"})
-        except Exception as e:
-            _orig_print(traceback.format_exc(), file=sys.stderr, flush=True)
-            emit({"id": req_id, "error": str(e)})
+    # Les réponses sont émises dans l'ordre de complétion (corrélées par "id")
+    pool = ThreadPoolExecutor(
+        max_workers=max(1, int(os.getenv("OCR_CONCURRENCY", 1))),
+        thread_name_prefix="ocr-req",
+    )
+    try:
+        for raw_line in sys.stdin.buffer:
+            raw_line = raw_line.strip()
+            if not raw_line:
+                continue
+            fut = pool.submit(handle_request, model, raw_line, cache_dir, cache_max_bytes, model_id)
+            fut.add_done_callback(_log_request_failure)
+    finally:
+        pool.shutdown(wait=True)
 
 
 if __name__ == "__main__":
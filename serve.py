@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Lanceur « zygote » des workers OCR — importe PaddleOCR UNE SEULE FOIS, puis
+fork un ocr_worker par demande. Les workers héritent du cache d'imports
+(Python + Paddle) en copy-on-write au lieu de payer 1-3 s d'import chacun.
+
+Modes :
+  python3 serve.py           → zygote : écoute sur OCR_ZYGOTE_SOCKET
+                               stdout → {"ready": true} une fois les imports faits
+  python3 serve.py --attach  → remplace `ocr_worker.py` côté server.js :
+                               transmet ses stdin/stdout/stderr au zygote (SCM_RIGHTS),
+                               qui fork un worker branché dessus. Le client relaie
+                               les signaux au worker et reprend son code de sortie.
+
+Options (env) :
+  OCR_ZYGOTE_SOCKET : /tmp/ocr-zygote.sock (défaut)
+"""
+
+import ctypes
+import os
+import select
+import signal
+import socket
+import sys
+import traceback
+
+SOCKET_PATH = os.getenv("OCR_ZYGOTE_SOCKET", "/tmp/ocr-zygote.sock")
+
+
+def _log(msg: str) -> None:
+    print(f"[zygote pid={os.getpid()}] {msg}", file=sys.stderr, flush=True)
+
+
+def _malloc_trim() -> None:
+    """Rend au système la mémoire libre du tas (glibc) : moins de pages à dupliquer en COW."""
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+# ── Zygote ───────────────────────────────────────────────────────────────────
+
+def _kill(pid: int) -> None:
+    """SIGKILL un worker ; sa récolte (waitpid) reste faite par la boucle du zygote."""
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _run_child(fds) -> None:
+    """Dans le fils : branche stdin/stdout/stderr sur les fds du client, lance le worker."""
+    import ocr_worker
+
+    for target, fd in zip((0, 1, 2), fds):
+        os.dup2(fd, target)
+        os.close(fd)
+
+    code = 0
+    try:
+        ocr_worker.main()
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def zygote() -> None:
+    import ocr_worker
+
+    # FLAGS_use_mkldnn & co sont lus à l'import de paddle : même décision que load_model()
+    ocr_worker.resolve_model_config()
+
+    import numpy  # noqa: F401
+    import fitz  # noqa: F401
+    import paddleocr  # noqa: F401
+
+    _malloc_trim()
+
+    if os.path.exists(SOCKET_PATH):
+        os.unlink(SOCKET_PATH)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(SOCKET_PATH)
+    server.listen(16)
+
+    _log(f"Imports ready, listening on {SOCKET_PATH}")
+    ocr_worker.emit({"ready": True})
+
+    children = {}  # conn -> pid
+
+    while True:
+        readable, _, _ = select.select([server, *children], [], [], 0.5)
+
+        for sock in readable:
+            if sock is server:
+                try:
+                    conn, _ = server.accept()
+                except OSError as e:
+                    _log(f"Accept failed: {e}")
+                    continue
+                try:
+                    _msg, fds, _flags, _addr = socket.recv_fds(conn, 16, 3)
+                except OSError as e:
+                    _log(f"Bad attach request: {e}")
+                    conn.close()
+                    continue
+                if len(fds) != 3:
+                    for fd in fds:
+                        os.close(fd)
+                    conn.close()
+                    continue
+
+                _malloc_trim()
+                try:
+                    pid = os.fork()
+                except OSError as e:
+                    _log(f"Fork failed: {e}")
+                    for fd in fds:
+                        os.close(fd)
+                    conn.close()
+                    continue
+                if pid == 0:
+                    server.close()
+                    conn.close()
+                    for other in children:
+                        other.close()
+                    _run_child(fds)
+
+                for fd in fds:
+                    os.close(fd)
+                try:
+                    conn.sendall(f"{pid}\n".encode())
+                except OSError as e:
+                    # Client mort pendant la poignée de main : personne ne lira ce worker
+                    _log(f"Client gone before handshake, killing worker pid={pid}: {e}")
+                    _kill(pid)
+                    conn.close()
+                    continue
+                children[conn] = pid
+                _log(f"Forked worker pid={pid}")
+            else:
+                # Client parti (ex. SIGKILL par server.js) → son worker n'a plus de raison d'être
+                try:
+                    gone = not sock.recv(1)
+                except OSError:
+                    gone = True
+                if gone:
+                    pid = children.pop(sock)
+                    sock.close()
+                    _kill(pid)
+
+        # Récolte des workers terminés → code de sortie renvoyé à leur client.
+        # Indépendant de `children` : un worker tué après le départ de son
+        # client n'y figure plus mais doit être récolté (sinon zombie).
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            code = os.waitstatus_to_exitcode(status)
+            if code < 0:
+                code = 128 - code  # tué par un signal (convention shell)
+            for conn, child_pid in list(children.items()):
+                if child_pid == pid:
+                    del children[conn]
+                    try:
+                        conn.sendall(f"{code}\n".encode())
+                    except OSError:
+                        pass
+                    conn.close()
+
+
+# ── Client (--attach) ────────────────────────────────────────────────────────
+
+def attach() -> None:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(SOCKET_PATH)
+    socket.send_fds(sock, [b"attach"], [0, 1, 2])
+
+    replies = sock.makefile("rb")
+    line = replies.readline()
+    if not line.strip():
+        print("[attach] zygote closed the connection", file=sys.stderr, flush=True)
+        sys.exit(1)
+    pid = int(line)
+
+    def forward(signum, _frame):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+
+    line = replies.readline()
+    sys.exit(int(line) if line.strip() else 1)
+
+
+if __name__ == "__main__":
+    if "--attach" in sys.argv[1:]:
+        attach()
+    else:
+        zygote()
@@ -20,7 +20,19 @@ const QUEUE_MAX_SIZE = Number(process.env.QUEUE_MAX_SIZE) || 50;
 // Défaut : nb de CPU logiques, plafonné à 4.
 const WORKER_COUNT = Number(process.env.WORKER_COUNT) || Math.min(os.cpus().length, 4);
 
+// Requêtes traitées en parallèle par un même worker (pool de threads côté Python :
+// rendu PDF / cache en parallèle, inférence PaddleOCR sérialisée). Opt-in : au-delà
+// de 1, les requêtes d'un worker se partagent un prédicteur et chaque OCR_TIMEOUT_MS
+// inclut l'attente des autres — utile surtout si le cache répond à beaucoup de requêtes.
+const WORKER_CONCURRENCY = Number(process.env.OCR_CONCURRENCY) || 1;
+
 const WORKER_PATH = new URL("ocr_worker.py", import.meta.url).pathname;
+
+// WORKER_PRELOAD=1 : un processus « zygote » (serve.py) importe PaddleOCR une fois,
+// chaque worker est ensuite forké depuis lui (imports partagés en copy-on-write).
+const WORKER_PRELOAD = process.env.WORKER_PRELOAD === "1";
+const LAUNCHER_PATH = new URL("serve.py", import.meta.url).pathname;
+const ZYGOTE_SOCKET = process.env.OCR_ZYGOTE_SOCKET || path.join(os.tmpdir(), "ocr-zygote.sock");
 const PDF_MAGIC = Buffer.from([0x25, 0x50, 0x44, 0x46]);
 
 const SUPPORTED_LANGS = new Set([
@@ -29,10 +41,17 @@ const SUPPORTED_LANGS = new Set([
 ]);
 
 // DPI : garde-fous (évite PDF->images énormes qui explosent RAM/CPU)
-const DEFAULT_DPI = Number(process.env.DEFAULT_DPI) || 300;
+const DEFAULT_DPI = Number(process.env.DEFAULT_DPI) || 200;
 const MIN_DPI = Number(process.env.MIN_DPI) || 120;
 const MAX_DPI = Number(process.env.MAX_DPI) || 400;
 
+// "fixed" : DPI demandé tel quel — "adaptive" : le worker choisit le DPI (150-300)
+// d'après la taille du texte de la première page à OCRiser.
+const DPI_POLICIES = new Set(["fixed", "adaptive"]);
+
+// Prétraitement optionnel avant OCR — "binarize" : seuillage noir/blanc (Numba)
+const PREPROCS = new Set(["binarize"]);
+
 // ─── Logger ───────────────────────────────────────────────────────────────────
 
 function log(level, msg, extra = {}) {
@@ -41,6 +60,19 @@ function log(level, msg, extra = {}) {
     );
 }
 
+// ─── Python env ───────────────────────────────────────────────────────────────
+
+// En mode preload, les workers héritent de l'env du zygote (et non de `serve.py --attach`)
+function workerEnv() {
+    return {
+        ...process.env,
+        PYTHONUNBUFFERED: "1",
+        FLAGS_call_stack_level: "2",
+        OCR_CONCURRENCY: String(WORKER_CONCURRENCY),
+        OCR_ZYGOTE_SOCKET: ZYGOTE_SOCKET,
+    };
+}
+
 // ─── Single Python Worker ─────────────────────────────────────────────────────
 
 class PythonWorker {
@@ -49,7 +81,7 @@ class PythonWorker {
     #rl = null;
     #pending = new Map();     // reqId → { resolve, reject, timer }
     #ready = false;
-    #busy = false;
+    #inflight = 0;            // requêtes envoyées au worker, sans réponse
     #_resolveReady;
     #_rejectReady;
     #readyPromise;
@@ -62,7 +94,8 @@ class PythonWorker {
 
     get id() { return this.#id; }
     get ready() { return this.#ready; }
-    get busy() { return this.#busy; }
+    get busy() { return this.#inflight >= WORKER_CONCURRENCY; }
+    get inflight() { return this.#inflight; }
 
     start() {
         this.#ready = false;
@@ -71,9 +104,10 @@ class PythonWorker {
             this.#_rejectReady = rej;
         });
 
-        this.#proc = spawn("python3", ["-u", WORKER_PATH], {
+        const args = WORKER_PRELOAD ? ["-u", LAUNCHER_PATH, "--attach"] : ["-u", WORKER_PATH];
+        this.#proc = spawn("python3", args, {
             stdio: ["pipe", "pipe", "pipe"],
-            env: { ...process.env, PYTHONUNBUFFERED: "1", FLAGS_call_stack_level: "2" },
+            env: workerEnv(),
         });
 
         // ✅ IMPORTANT: ne pas écraser `msg` dans log()
@@ -94,7 +128,7 @@ class PythonWorker {
         this.#proc.once("close", (code) => {
             clearTimeout(readyTimer);
             this.#ready = false;
-            this.#busy = false;
+            this.#inflight = 0;
             log("error", `worker-${this.#id} exited`, { code });
 
             for (const [, { reject: rej, timer }] of this.#pending) {
@@ -138,37 +172,51 @@ class PythonWorker {
             return;
         }
 
+        // Réponses partielles (requêtes "stream") : non utilisées par le serveur HTTP
+        if (msg.partial_text !== undefined) return;
+
         const pending = this.#pending.get(msg.id);
         if (!pending) return;
 
         clearTimeout(pending.timer);
         this.#pending.delete(msg.id);
-        this.#busy = false;
-        this.#pool.onWorkerFree(this.#id);
+        this.#release();
 
         if (msg.error) pending.reject(new Error(msg.error));
         else pending.resolve({ text: msg.text ?? "", page_count: msg.page_count ?? null });
     }
 
-    async ocr(pdfPath, { dpi, lang } = {}) {
-        await this.#readyPromise;
+    #release() {
+        this.#inflight = Math.max(0, this.#inflight - 1);
+        this.#pool.onWorkerFree(this.#id);
+    }
+
+    async ocr(pdfPath, { dpi, dpiPolicy, preproc, lang } = {}) {
+        // Slot réservé dès l'appel (avant tout await) : le pool voit la charge immédiatement
+        this.#inflight++;
+        try {
+            await this.#readyPromise;
+        } catch (e) {
+            this.#release();
+            throw e;
+        }
 
         const id = randomBytes(8).toString("hex");
 
         return new Promise((resolve, reject) => {
             const timer = setTimeout(() => {
                 this.#pending.delete(id);
-                this.#busy = false;
-                this.#pool.onWorkerFree(this.#id);
+                this.#release();
                 reject(new Error(`OCR timed out after ${OCR_TIMEOUT_MS}ms`));
             }, OCR_TIMEOUT_MS);
 
-            this.#busy = true;
             this.#pending.set(id, { resolve, reject, timer });
 
             // ✅ On passe dpi et lang (lang peut être ignoré côté worker si tu n’en as pas besoin)
             const payload = { id, pdf_path: pdfPath };
             if (Number.isFinite(dpi)) payload.dpi = dpi;
+            if (typeof dpiPolicy === "string" && dpiPolicy.length) payload.dpi_policy = dpiPolicy;
+            if (typeof preproc === "string" && preproc.length) payload.preproc = preproc;
             if (typeof lang === "string" && lang.length) payload.lang = lang;
 
             this.#proc.stdin.write(JSON.stringify(payload) + "\n");
@@ -245,7 +293,7 @@ class WorkerPool {
 
     #drainQueue() {
         for (const worker of this.#workers) {
-            if (!worker.busy && worker.ready && this.#queue.length > 0) {
+            while (!worker.busy && worker.ready && this.#queue.length > 0) {
                 const job = this.#queue.shift();
                 clearTimeout(job.queueTimer);
                 this.#dispatch(worker, job);
@@ -260,7 +308,10 @@ class WorkerPool {
     }
 
     async run(pdfPath, reqId, opts) {
-        const freeWorker = this.#workers.find(w => w.ready && !w.busy);
+        // Worker le moins chargé parmi ceux qui ont encore un slot libre
+        const freeWorker = this.#workers
+            .filter(w => w.ready && !w.busy)
+            .sort((a, b) => a.inflight - b.inflight)[0];
         if (freeWorker) {
             return freeWorker.ocr(pdfPath, opts);
         }
@@ -284,7 +335,7 @@ class WorkerPool {
 
     get stats() {
         return {
-            workers: this.#workers.map(w => ({ id: w.id, ready: w.ready, busy: w.busy })),
+            workers: this.#workers.map(w => ({ id: w.id, ready: w.ready, busy: w.busy, inflight: w.inflight })),
             queue_size: this.#queue.length,
         };
     }
@@ -324,6 +375,30 @@ function sanitizeDpi(raw) {
     return Math.round(dpi);
 }
 
+function sanitizeDpiPolicy(raw) {
+    if (raw === undefined || raw === null || raw === "") return undefined;
+    const policy = raw.toString().toLowerCase().trim();
+    if (!DPI_POLICIES.has(policy)) {
+        throw Object.assign(
+            new Error(`Invalid dpi_policy: '${policy}'. Supported: ${[...DPI_POLICIES].join(", ")}`),
+            { status: 400 }
+        );
+    }
+    return policy;
+}
+
+function sanitizePreproc(raw) {
+    if (raw === undefined || raw === null || raw === "") return undefined;
+    const preproc = raw.toString().toLowerCase().trim();
+    if (!PREPROCS.has(preproc)) {
+        throw Object.assign(
+            new Error(`Invalid preproc: '${preproc}'. Supported: ${[...PREPROCS].join(", ")}`),
+            { status: 400 }
+        );
+    }
+    return preproc;
+}
+
 // ─── OCR pipeline ─────────────────────────────────────────────────────────────
 
 async function runOcr({ buffer, reqId, opts }) {
@@ -367,6 +442,8 @@ app.post("/ocr", upload.single("file"), async (req, res) => {
 
     let lang;
     let dpi;
+    let dpiPolicy;
+    let preproc;
 
     try { lang = sanitizeLang(req.query.lang || "fra"); }
     catch (e) { return res.status(e.status || 400).json({ error: e.message }); }
@@ -374,18 +451,26 @@ app.post("/ocr", upload.single("file"), async (req, res) => {
     try { dpi = sanitizeDpi(req.query.dpi); }
     catch (e) { return res.status(e.status || 400).json({ error: e.message }); }
 
+    try { dpiPolicy = sanitizeDpiPolicy(req.query.dpi_policy); }
+    catch (e) { return res.status(e.status || 400).json({ error: e.message }); }
+
+    try { preproc = sanitizePreproc(req.query.preproc); }
+    catch (e) { return res.status(e.status || 400).json({ error: e.message }); }
+
     const t0 = Date.now();
     try {
         const result = await runOcr({
             buffer: req.file.buffer,
             reqId,
-            opts: { dpi, lang },
+            opts: { dpi, dpiPolicy, preproc, lang },
         });
 
         log("info", "ocr done", {
             reqId,
             lang,
             dpi,
+            dpiPolicy,
+            preproc,
             pages: result.page_count,
             chars: result.text.length,
             ms: Date.now() - t0
@@ -406,12 +491,61 @@ app.use((err, _req, res, _next) => {
     res.status(500).json({ error: "Internal server error" });
 });
 
+// ─── Zygote (WORKER_PRELOAD=1) ────────────────────────────────────────────────
+
+function startZygote() {
+    return new Promise((resolve, reject) => {
+        let ready = false;
+        const proc = spawn("python3", ["-u", LAUNCHER_PATH], {
+            stdio: ["ignore", "pipe", "pipe"],
+            env: workerEnv(),
+        });
+
+        proc.stderr.on("data", (d) =>
+            log("info", "zygote stderr", { stderr: d.toString().trim().slice(0, 2000) })
+        );
+
+        readline.createInterface({ input: proc.stdout }).on("line", (line) => {
+            try {
+                if (JSON.parse(line).ready === true && !ready) {
+                    ready = true;
+                    clearTimeout(readyTimer);
+                    resolve(proc);
+                }
+            } catch {
+                log("error", "zygote invalid JSON", { raw: line.slice(0, 200) });
+            }
+        });
+
+        const readyTimer = setTimeout(() => {
+            if (!ready) {
+                reject(new Error("Zygote ready timeout"));
+                proc.kill("SIGKILL");
+            }
+        }, WORKER_READY_TIMEOUT);
+
+        proc.once("close", (code) => {
+            clearTimeout(readyTimer);
+            if (!ready) return reject(new Error(`Zygote exited before ready (exit ${code})`));
+            // Plus de zygote → plus de redémarrage possible des workers
+            log("error", "Fatal: zygote exited", { code });
+            process.exit(1);
+        });
+
+        proc.on("error", (e) => {
+            clearTimeout(readyTimer);
+            reject(new Error(`zygote spawn error: ${e.message}`));
+        });
+    });
+}
+
 // ─── Boot ─────────────────────────────────────────────────────────────────────
 
-pool.init(WORKER_COUNT)
+(WORKER_PRELOAD ? startZygote() : Promise.resolve())
+    .then(() => pool.init(WORKER_COUNT))
     .then(() => {
         app.listen(PORT, () =>
-            log("info", `OCR service listening on :${PORT}`, { workers: WORKER_COUNT, engine: "paddleocr-pool" })
+            log("info", `OCR service listening on :${PORT}`, { workers: WORKER_COUNT, engine: "paddleocr-pool", preload: WORKER_PRELOAD })
         );
     })
     .catch((e) => {